@@ -1,15 +1,24 @@
+import io
 import os
+import sys
+import shutil
+import hashlib
 import time
 import json
+import tempfile
+import threading
 import re
 import warnings
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 import gspread
-from PIL import Image
+from PIL import Image, ImageOps
 from gtts import gTTS
-from pydub import AudioSegment
-from pydub.effects import speedup
+from mutagen.mp3 import MP3
 from duckduckgo_search import DDGS
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
@@ -18,11 +27,32 @@ from googleapiclient.http import MediaFileUpload
 # --- CONFIGURATION ---
 IMAGE_COUNT = 20
 TARGET_SIZE = (1920, 1080)
-DOWNLOAD_DIR = "video_images"
-OUTPUT_VIDEO = "drama_final_video.mp4"
+# Per-run scratch space on tmpfs (RAM) when it has room for the raw frames, else the normal temp dir
+SHM_DIR = "/dev/shm"
+SHM_MIN_FREE = 1 << 30
+# WORK_DIR, DOWNLOAD_DIR and OUTPUT_VIDEO are created per run by main(), never at import
+WORK_DIR = None
+DOWNLOAD_DIR = None
+FRAME_EXT = ".ppm"  # Uncompressed frames: ffmpeg reads raw pixels instead of running libjpeg
+OUTPUT_VIDEO = None  # "<WORK_DIR>/drama_final_video_{row_num}.mp4", one per row since uploads run in the background
 AUDIO_SPEEDUP_FACTOR = 1.4
+DOWNLOAD_WORKERS = 16
+# Characters that break DDG (anything but word chars, spaces and Devanagari)
+QUERY_STRIP_RE = re.compile(r'[^\w\s\u0900-\u097F]')
+TTS_CACHE_DIR = "tts_cache"
+NEAR_DUPLICATE_BITS = 5  # dHash distance below which two images count as the same picture
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+# One keep-alive pool for every HTTP call (image fetches, uploads)
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "Mozilla/5.0"
+# Only idempotent reads are retried; a failed upload goes to the next host instead of re-sending the video
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                       max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                                         allowed_methods={"GET", "HEAD"}))
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
 def get_gcp_credentials():
     info = json.loads(os.environ['GCP_SERVICE_ACCOUNT'])
     return Credentials.from_service_account_info(info, scopes=[
@@ -31,69 +61,175 @@ def get_gcp_credentials():
     ])
 
 # --- PHASE 1: AUDIO (Direct from Script) ---
-def generate_audio(text, output_path):
+def cached_tts(text, lang):
+    """Returns the path of the gTTS MP3 for a script, synthesizing only on a cache miss.
+
+    The speed-up is applied later inside render_video, so the cache holds gTTS' own output.
+    """
+    # Whitespace-only edits in the sheet should still hit the cache (gTTS itself gets the text as written)
+    normalized = " ".join(text.split())
+    key = hashlib.sha1(f"{lang}|{normalized}".encode()).hexdigest()
+    cache_path = os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+    if os.path.exists(cache_path):
+        print("♻️ Reusing cached voice")
+        # Refresh mtime so the workflow's age-based pruning keeps voices that are still in use
+        os.utime(cache_path)
+        return cache_path
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    tts = gTTS(text=text, lang=lang)
+    tts.save(cache_path + ".part")
+    os.replace(cache_path + ".part", cache_path)
+    return cache_path
+
+def clear_tts_cache():
+    shutil.rmtree(TTS_CACHE_DIR, ignore_errors=True)
+    print("🧹 Cleared TTS cache")
+
+def generate_audio(text):
     print(f"🎙️ Generating AI Voice from Script...")
-    temp_audio = "temp_gtts.mp3"
     # Uses gTTS for Hindi
-    tts = gTTS(text=text, lang='hi')
-    tts.save(temp_audio)
-    
-    audio = AudioSegment.from_file(temp_audio)
-    # Speeding it up for engagement
-    fast_audio = speedup(audio, playback_speed=AUDIO_SPEEDUP_FACTOR)
-    fast_audio.export(output_path, format="mp3")
-    os.remove(temp_audio)
-    return output_path
+    return cached_tts(text, 'hi')
 
 # --- PHASE 2: IMAGES (Full Title Search) ---
+def _dhash(img):
+    """64-bit difference hash: near-identical pictures (re-encoded, resized) differ in only a few bits."""
+    small = img.convert("L").resize((9, 8), Image.Resampling.BILINEAR)
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits
+
+def _fetch_one(url, index, seen, seen_lock):
+    """Downloads one image and saves it as a raw 1080p frame. Returns (path, dhash) or None."""
+    try:
+        # Stream so failed responses are dropped before the body is read; PIL decides what is an image
+        with SESSION.get(url, timeout=10, stream=True) as r:
+            if r.status_code != 200:
+                return None
+            data = r.content
+        # Byte-identical results (mirrors, repeated hits) are only processed once per row
+        digest = hashlib.sha1(data).hexdigest()
+        with seen_lock:
+            if digest in seen:
+                return None
+            seen.add(digest)
+        path = os.path.join(DOWNLOAD_DIR, f"img_{index:02d}{FRAME_EXT}")
+        with Image.open(io.BytesIO(data)) as img:
+            # Let libjpeg decode large sources at a reduced DCT scale (no-op for other formats)
+            img.draft("RGB", TARGET_SIZE)
+            img = img.convert("RGB")
+            # Hash the picture itself: letterbox bars would dominate the 9x8 grid of portrait sources
+            fingerprint = _dhash(img)
+            # Letterbox to exactly 1080p so ffmpeg needs no scale/pad
+            img = ImageOps.pad(img, TARGET_SIZE, method=Image.Resampling.BILINEAR, color=(0, 0, 0))
+        img.save(path, "PPM")
+        return path, fingerprint
+    except Exception:
+        return None
+
 def download_images(query):
     if not os.path.exists(DOWNLOAD_DIR): os.makedirs(DOWNLOAD_DIR)
     # Clean query to remove characters that break DDG
-    search_query = re.sub(r'[^\w\s\u0900-\u097F]', '', query)
+    search_query = QUERY_STRIP_RE.sub('', query)
     print(f"🖼️ Searching for Title: {search_query}")
     
     with DDGS() as ddgs:
         results = list(ddgs.images(search_query, max_results=IMAGE_COUNT + 10))
     
-    count = 0
-    for res in results:
-        if count >= IMAGE_COUNT: break
-        try:
-            r = requests.get(res['image'], timeout=10)
-            if r.status_code == 200:
-                temp_p = "temp.jpg"
-                with open(temp_p, "wb") as f: f.write(r.content)
-                with Image.open(temp_p) as img:
-                    # Convert to RGB and resize to 1080p
-                    img = img.convert("RGB").resize(TARGET_SIZE, Image.Resampling.LANCZOS)
-                    img.save(os.path.join(DOWNLOAD_DIR, f"img_{count}.jpg"), "JPEG")
-                count += 1
-                print(f"✅ Saved Image {count}")
-        except: continue
-    return count
+    # Fetch every candidate at once over the shared keep-alive pool
+    seen, seen_lock = set(), threading.Lock()
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        futures = [ex.submit(_fetch_one, res['image'], i, seen, seen_lock) for i, res in enumerate(results[:IMAGE_COUNT + 10])]
+        saved = [res for res in (fut.result() for fut in futures) if res]
+    
+    # Keep the first IMAGE_COUNT distinct ones, in search-result order
+    kept = []
+    dupes = 0
+    for path, fingerprint in saved:
+        if any(bin(fingerprint ^ other).count("1") < NEAR_DUPLICATE_BITS for other in kept):
+            dupes += 1
+            os.remove(path)
+        elif len(kept) >= IMAGE_COUNT:
+            os.remove(path)
+        else:
+            kept.append(fingerprint)
+    print(f"✅ Saved {len(kept)} Images ({dupes} near-duplicates skipped)")
+    return len(kept)
 
 # --- PHASE 3: FAST VIDEO ASSEMBLY ---
+# Hardware encoders in order of preference, libx264 is the CPU fallback
+HW_ENCODERS = ["h264_nvenc", "h264_amf", "h264_qsv"]
+ENCODER_ARGS = {
+    "h264_nvenc": ["-preset", "p1", "-tune", "ll", "-2pass", "0", "-rc", "constqp", "-qp", "23"],
+    "h264_amf": ["-usage", "transcoding", "-quality", "speed"],
+    "h264_qsv": ["-preset", "veryfast"],
+    "libx264": ["-preset", "ultrafast", "-tune", "stillimage", "-x264-params", "scenecut=0:keyint=9999"],
+}
+
+def pick_video_encoder():
+    """Returns the fastest H.264 encoder that actually works on this machine."""
+    try:
+        listing = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    except OSError:
+        return "libx264"
+    for enc in HW_ENCODERS:
+        if enc not in listing:
+            continue
+        # Distro builds list NVENC/AMF/QSV even without the GPU, so probe with a 1-frame encode
+        probe = ['ffmpeg', '-hide_banner', '-v', 'error', '-f', 'lavfi', '-i', 'color=black:s=256x256',
+                 '-frames:v', '1', '-c:v', enc, '-f', 'null', '-']
+        if subprocess.run(probe, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            return enc
+    return "libx264"
+
+VIDEO_ENCODER = None  # Picked by main() so importing this module spawns no ffmpeg
+
 def get_duration(path):
-    cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', path]
-    return float(subprocess.run(cmd, stdout=subprocess.PIPE).stdout)
+    # Read from the MP3 headers in-process instead of spawning ffprobe
+    info = MP3(path).info
+    if not info.bitrate:
+        return info.length
+    # gTTS writes one MP3 per text chunk back to back and mutagen trusts the first chunk's
+    # Xing/Info header, so fall back to the size/bitrate estimate (as ffprobe does) when they disagree
+    estimate = os.path.getsize(path) * 8 / info.bitrate
+    if abs(info.length - estimate) > 0.1 * estimate:
+        return estimate
+    return info.length
 
 def render_video(audio_path, output_path):
-    img_files = sorted([f for f in os.listdir(DOWNLOAD_DIR) if f.endswith('.jpg')])
-    duration = get_duration(audio_path)
-    img_dur = duration / len(img_files)
-    
-    with open("list.txt", "w") as f:
-        for img in img_files:
-            f.write(f"file '{DOWNLOAD_DIR}/{img}'\nduration {img_dur}\n")
-        f.write(f"file '{DOWNLOAD_DIR}/{img_files[-1]}'\n")
+    img_files = sorted([f for f in os.listdir(DOWNLOAD_DIR) if f.endswith(FRAME_EXT)])
+    # The voice is sped up during this encode, so the video must match the shortened length
+    duration = get_duration(audio_path) / AUDIO_SPEEDUP_FACTOR
+    # One input frame per image: each still is decoded and encoded once instead of 24x per second
+    # No -shortest: the rate already makes the stills span the voice, and -shortest drops the last still
+    frame_rate = len(img_files) / duration
 
-    # Ultra-fast FFmpeg command
-    cmd = f"ffmpeg -y -f concat -safe 0 -i list.txt -i {audio_path} -c:v libx264 -preset ultrafast -tune stillimage -vf \"scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,format=yuv420p\" -r 24 -c:a aac -shortest {output_path}"
-    subprocess.run(cmd, shell=True)
+    # Ultra-fast FFmpeg command (GPU encoder when available)
+    print(f"🎬 Encoding with {VIDEO_ENCODER}")
+    cmd = ["ffmpeg", "-y", "-framerate", f"{frame_rate:.6f}", "-pattern_type", "glob",
+           "-i", os.path.join(DOWNLOAD_DIR, f"img_*{FRAME_EXT}"), "-i", audio_path,
+           "-c:v", VIDEO_ENCODER, *ENCODER_ARGS[VIDEO_ENCODER],
+           # Frames are already TARGET_SIZE, only the RGB -> YUV420 conversion is left
+           "-vf", "format=yuv420p",
+           # Keep the input timing: the MP4 is a sub-1 fps stream where each still carries its own duration
+           "-fps_mode", "vfr",
+           # Speeding it up for engagement, in the same pass as the AAC encode
+           "-filter:a", f"atempo={AUDIO_SPEEDUP_FACTOR}", "-c:a", "aac", output_path]
+    # argv list, no shell: titles and paths need no quoting
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        raise RuntimeError(f"ffmpeg failed with exit code {result.returncode}")
 
 # --- FILE UPLOAD (pixeldrain → GoFile → litterbox) ---
 def upload_video_file(file_path):
-    """Primary: pixeldrain.com | 2nd: GoFile | 3rd: litterbox.catbox.moe"""
+    """Primary: pixeldrain.com | 2nd: GoFile | 3rd: litterbox.catbox.moe
+
+    Bodies are streamed from disk (raw PUT / MultipartEncoder), so memory stays flat
+    regardless of the video size.
+    """
 
     filename = os.path.basename(file_path)
 
@@ -101,7 +237,7 @@ def upload_video_file(file_path):
     print("📤 Uploading to pixeldrain.com...")
     try:
         with open(file_path, "rb") as f:
-            response = requests.put(
+            response = SESSION.put(
                 f"https://pixeldrain.com/api/file/{filename}",
                 data=f,
                 headers={"Content-Type": "video/mp4"},
@@ -121,9 +257,11 @@ def upload_video_file(file_path):
     print("☁️ Uploading to GoFile...")
     try:
         with open(file_path, "rb") as f:
-            response = requests.post(
+            enc = MultipartEncoder(fields={"file": (filename, f, "video/mp4")})
+            response = SESSION.post(
                 "https://store1.gofile.io/contents/uploadfile",
-                files={"file": (filename, f, "video/mp4")},
+                data=enc,
+                headers={"Content-Type": enc.content_type},
                 timeout=300
             ).json()
         if response.get('status') == 'ok':
@@ -139,10 +277,15 @@ def upload_video_file(file_path):
     print("📦 Uploading to litterbox.catbox.moe...")
     try:
         with open(file_path, "rb") as f:
-            response = requests.post(
+            enc = MultipartEncoder(fields={
+                "reqtype": "fileupload",
+                "time": "72h",
+                "fileToUpload": (filename, f, "video/mp4"),
+            })
+            response = SESSION.post(
                 "https://litterbox.catbox.moe/resources/internals/api.php",
-                data={"reqtype": "fileupload", "time": "72h"},
-                files={"fileToUpload": (filename, f, "video/mp4")},
+                data=enc,
+                headers={"Content-Type": enc.content_type},
                 timeout=300
             )
         if response.status_code == 200:
@@ -154,8 +297,52 @@ def upload_video_file(file_path):
     except Exception as e:
         print(f"❌ All uploaders failed: {e}")
 
+# --- SHEET UPDATES ---
+STATUS_COL = "D"
+LINK_COL = "F"
+
+def cell_update(col, row_num, value):
+    """One range entry for worksheet.batch_update()."""
+    return {"range": f"{col}{row_num}", "values": [[value]]}
+
+# --- BACKGROUND UPLOADS ---
+# Uploads are network-bound, so they run here while the next row renders
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+def _upload_and_cleanup(file_path):
+    try:
+        return upload_video_file(file_path)
+    finally:
+        if os.path.exists(file_path): os.remove(file_path)
+
+def collect_uploads(uploads, updates, wait=False):
+    """Moves finished uploads (all of them when wait=True) out of uploads and adds each row's final status to updates."""
+    row_of = {fut: row_num for row_num, fut in uploads}
+    finished = as_completed(row_of) if wait else [fut for fut in row_of if fut.done()]
+    for fut in finished:
+        row_num = row_of[fut]
+        uploads.remove((row_num, fut))
+        try:
+            video_url = fut.result()
+        except Exception as e:
+            updates.append(cell_update(STATUS_COL, row_num, f"Error: {str(e)[:50]}"))
+            continue
+        if video_url:
+            updates.append(cell_update(STATUS_COL, row_num, "Completed"))
+            updates.append(cell_update(LINK_COL, row_num, video_url))
+            print(f"✅ Row {row_num} uploaded: {video_url}")
+        else:
+            updates.append(cell_update(STATUS_COL, row_num, "Upload Failed"))
+
+def flush_updates(sheet, updates):
+    """Writes the queued cells in one request."""
+    if updates:
+        sheet.batch_update(updates)
+        print(f"📝 Updated {len(updates)} cell(s) in sheet")
+        updates.clear()
+
 # --- MAIN AUTOMATION LOOP ---
-def main():
+def run_bot():
     # 1. Initialize Credentials
     creds = get_gcp_credentials()
     gc = gspread.authorize(creds)
@@ -185,6 +372,19 @@ def main():
     pending_count = sum(1 for row in records if row.get('Status', '').strip() in ['', 'Pending'])
     print(f"⏳ Rows to process (empty or 'Pending' status): {pending_count}")
 
+    # Row results are queued and written in one batch after each row, then once more for uploads still running at the end
+    updates = []
+    uploads = []
+    try:
+        process_rows(sheet, records, updates, uploads)
+    finally:
+        # Write what is already known before blocking on slow uploads, so a cancel mid-wait loses nothing queued
+        collect_uploads(uploads, updates)
+        flush_updates(sheet, updates)
+        collect_uploads(uploads, updates, wait=True)
+        flush_updates(sheet, updates)
+
+def process_rows(sheet, records, updates, uploads):
     for i, row in enumerate(records):
         row_num = i + 2
         # Process rows with empty status OR "Pending" status
@@ -201,45 +401,52 @@ def main():
 
                 if not script:
                     print(f"❌ No script available (no Script text and no transcript). Skipping.")
-                    sheet.update_cell(row_num, 4, "No Script")
+                    updates.append(cell_update(STATUS_COL, row_num, "No Script"))
                     continue
 
-                # 1. Voice from Script
-                generate_audio(script, "voice.mp3")
-                
-                # 2. Images from Title
-                download_images(title)
+                # 1 + 2. Voice from Script and Images from Title are independent, run them together
+                with ThreadPoolExecutor(max_workers=2) as stage:
+                    audio_job = stage.submit(generate_audio, script)
+                    images_job = stage.submit(download_images, title)
+                    voice_path = audio_job.result()
+                    images_job.result()
                 
                 # 3. Assemble Video
-                render_video("voice.mp3", OUTPUT_VIDEO)
-                
-                # 4. Upload video (0x0.st → catbox fallback)
-                video_url = upload_video_file(OUTPUT_VIDEO)
-                
-                if video_url:
-                    # 5. Update Sheet
-                    sheet.update_cell(row_num, 4, "Completed")
-                    sheet.update_cell(row_num, 6, video_url)
-                    print(f"✅ Updated sheet with Drive link: {video_url}")
-                else:
-                    sheet.update_cell(row_num, 4, "Upload Failed")
+                video_path = OUTPUT_VIDEO.format(row_num=row_num)
+                render_video(voice_path, video_path)
                 
-                # Cleanup for next loop
-                if os.path.exists(DOWNLOAD_DIR):
-                    for f in os.listdir(DOWNLOAD_DIR): 
-                        os.remove(os.path.join(DOWNLOAD_DIR, f))
-                
-                # Clean up temp files
-                if os.path.exists("voice.mp3"): os.remove("voice.mp3")
-                if os.path.exists("list.txt"): os.remove("list.txt")
-                if os.path.exists(OUTPUT_VIDEO): os.remove(OUTPUT_VIDEO)
+                # 4. Upload video in the background (pixeldrain → GoFile → litterbox fallback),
+                #    the sheet is updated once it finishes
+                uploads.append((row_num, UPLOAD_EXECUTOR.submit(_upload_and_cleanup, video_path)))
                 
             except Exception as e:
                 import traceback
                 error_msg = traceback.format_exc()
                 print(f"❌ Failed processing '{row['Title']}':")
                 print(error_msg)
-                sheet.update_cell(row_num, 4, f"Error: {str(e)[:50]}")
+                updates.append(cell_update(STATUS_COL, row_num, f"Error: {str(e)[:50]}"))
+            finally:
+                # Cleanup for next loop (also after a failure, so stale frames never leak into the next video)
+                shutil.rmtree(DOWNLOAD_DIR, ignore_errors=True)
+                # Write this row's failure status right away (a claimed row must not stay "Processing"),
+                # together with the links of uploads that finished meanwhile
+                collect_uploads(uploads, updates)
+                flush_updates(sheet, updates)
+
+def main():
+    global WORK_DIR, DOWNLOAD_DIR, OUTPUT_VIDEO, VIDEO_ENCODER
+    use_shm = os.path.isdir(SHM_DIR) and shutil.disk_usage(SHM_DIR).free > SHM_MIN_FREE
+    WORK_DIR = tempfile.mkdtemp(prefix="indra_", dir=SHM_DIR if use_shm else None)
+    DOWNLOAD_DIR = os.path.join(WORK_DIR, "video_images")
+    OUTPUT_VIDEO = os.path.join(WORK_DIR, "drama_final_video_{row_num}.mp4")
+    try:
+        VIDEO_ENCODER = pick_video_encoder()
+        run_bot()
+    finally:
+        # Every exit path (early returns, auth errors) removes the scratch dir
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
 
 if __name__ == "__main__":
+    if "--clear-tts-cache" in sys.argv[1:]:
+        clear_tts_cache()
     main()